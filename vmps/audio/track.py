@@ -1,20 +1,41 @@
 from __future__ import annotations
 
+import asyncio
+import io
 import logging
+import os
 import subprocess
+from operator import attrgetter
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
-import ffmpeg
-import yaml
-
-from vmps.utils import timecode2seconds
+from vmps.exec import run, run_pipeline
+from vmps.utils import FFMPEG_STRICT, probe, timecode2seconds
 
 logger = logging.getLogger("vmps")
 
 
 class AudioClip:
+    # tracks may hold many clips, avoid a per-instance __dict__
+    __slots__ = (
+        "workspace",
+        "asset",
+        "uid",
+        "track",
+        "channel",
+        "sample_rate",
+        "span",
+        "_start_s",
+        "_end_s",
+        "clip",
+        "volume",
+        "loop",
+        "shrink",
+        "path",
+        "normalized",
+    )
+
     def __init__(
         self,
         track: AudioTrack,
@@ -51,12 +72,13 @@ class AudioClip:
         self.channel = channel
         self.sample_rate = sample_rate if sample_rate else track.sample_rate
         self.span = span
+        self._start_s = timecode2seconds(span[0])
+        self._end_s = timecode2seconds(span[1])
         self.clip = clip
-        self.path = self.workspace / f"{uuid4().hex}.wav"
-        self.track = track
         self.volume = volume
         self.loop = loop
         self.shrink = shrink
+        self.path = self.workspace / f"{uuid4().hex}.wav"
         self.track.add_clip(self)
 
         self.workspace.mkdir(parents=True, exist_ok=True)
@@ -65,34 +87,72 @@ class AudioClip:
 
     @property
     def duration(self):
-        return round(timecode2seconds(self.span[1]) - timecode2seconds(self.span[0]), 4)
+        return round(self._end_s - self._start_s, 4)
 
     def normalize(self):
-        if self.normalized:
-            return
+        asyncio.run(self.normalize_async())
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
-        try:
-            actual_duration = float(ffmpeg.probe(self.asset.as_posix())["streams"][0]["duration"])
-        except ffmpeg.Error as e:
-            logger.error(e.stderr.decode("utf-8"))
-            raise e
+    @property
+    def passthrough(self):
+        """Whether the asset can be used as the clip as is: a whole mono wav file at the clip sample rate. The mixing
+        pipeline then reads it directly, see AudioTrack.unmixed_channel_path"""
+        if not self.asset.is_file() or self.asset.suffix.lower() != ".wav" or self.clip or self.volume is not None:
+            return False
+        stream = probe(self.asset)["streams"][0]
+        return (
+            int(stream["sample_rate"]) == self.sample_rate
+            and int(stream["channels"]) == 1
+            and round(float(stream["duration"]), 4) == self.duration
+        )
+
+    @property
+    def seekable(self):
+        """Whether ffmpeg can seek in the asset directly, otherwise the clip has to be normalized first"""
+        return self.asset.is_file()
+
+    @property
+    def probe_needed(self):
+        """Whether the asset has to be probed for its duration"""
+        return not (self.clip and self.clip[1])
+
+    def ffmpeg_args(self) -> Tuple[List[str], List[str]]:
+        """
+        Build the ffmpeg arguments that cut, loop and resample the asset to this clip.
+
+        Returns:
+            Input options of the asset (ending with "-i <asset>") and the filters to apply to its audio stream
+        """
+        input_args = []
+        if self.asset.suffix.lower() == ".wav":
+            # the stream parameters are in the header of a wav file, so keep stream probing brief. Other containers,
+            # e.g. video files or mp3 files with cover art, may need more than 32k to reach the audio stream
+            input_args.extend(["-analyzeduration", "100000", "-probesize", "32k"])
+        if not self.probe_needed:
+            # the end of the clip bounds its duration
+            actual_duration = timecode2seconds(self.clip[1])
+        else:
+            import ffmpeg
+
+            try:
+                actual_duration = float(probe(self.asset)["streams"][0]["duration"])
+            except ffmpeg.Error as e:
+                logger.error(e.stderr.decode("utf-8"))
+                raise e
         if self.clip:
             if self.clip[1]:
-                ffmpeg_cmd.extend(["-to", self.clip[1]])
-                actual_duration = timecode2seconds(self.clip[1])
+                input_args.extend(["-to", self.clip[1]])
             if self.clip[0]:
-                ffmpeg_cmd.extend(["-ss", self.clip[0]])
+                input_args.extend(["-ss", self.clip[0]])
                 actual_duration -= timecode2seconds(self.clip[0])
 
         actual_duration = round(actual_duration, 4)
-        expected_duration = round(timecode2seconds(self.span[1]) - timecode2seconds(self.span[0]), 4)
+        expected_duration = self.duration
         if actual_duration > expected_duration:
             if self.shrink == "trim_start":
                 seek_start_time = round(actual_duration - expected_duration, 4)
-                ffmpeg_cmd.extend(["-ss", str(seek_start_time)])
+                input_args.extend(["-ss", str(seek_start_time)])
             elif self.shrink == "trim_end":
-                ffmpeg_cmd.extend(["-to", str(expected_duration)])
+                input_args.extend(["-to", str(expected_duration)])
             else:
                 raise NotImplementedError(f"Shrink method '{self.shrink}' is not implemented")
         elif actual_duration < expected_duration and not self.loop:
@@ -100,27 +160,40 @@ class AudioClip:
                 f"Actual duration {actual_duration} < expected duration {expected_duration}, and loop is set to False"
             )
 
-        filter_complex = []
+        # resample first so that the loop size below is counted at the target sample rate
+        filters = [f"aresample={self.sample_rate}", "aformat=channel_layouts=mono"]
         if self.loop and actual_duration < expected_duration:
             loop_count = int(expected_duration // actual_duration) + 1
-            filter_complex.append(
+            filters.append(
                 f"aloop=loop={loop_count}:size={int(self.sample_rate * actual_duration)},"
                 f"atrim=duration={expected_duration}"
             )
 
         if self.volume is not None:
-            filter_complex.append(f"volume={self.volume}")
+            filters.append(f"volume={self.volume}")
+
+        input_args.extend(["-i", self.asset.as_posix()])
+        return input_args, filters
+
+    async def normalize_async(self, sem: Optional[asyncio.Semaphore] = None):
+        """
+        Args:
+            sem: Optional semaphore limiting how many ffmpeg processes run at the same time
+        """
+        if self.normalized:
+            return
 
-        ffmpeg_cmd.extend(["-i", self.asset.as_posix()])
-        if filter_complex:
-            ffmpeg_cmd.extend(["-filter_complex", ",".join(filter_complex)])
+        # ffmpeg_args may have to probe the asset, which blocks
+        input_args, filters = await asyncio.to_thread(self.ffmpeg_args)
+        ffmpeg_cmd = list(FFMPEG_STRICT)
+        ffmpeg_cmd.extend(input_args)
+        ffmpeg_cmd.extend(["-filter_complex", ",".join(filters)])
         ffmpeg_cmd.extend(["-ar", str(self.sample_rate)])
         ffmpeg_cmd.extend(["-ac", "1"])
         ffmpeg_cmd.append(self.path.as_posix())
 
         try:
-            logger.info(f"Normalizing {self.uid}: {' '.join(ffmpeg_cmd)}")
-            subprocess.run(ffmpeg_cmd, check=True)
+            await run(ffmpeg_cmd, sem, f"Normalizing {self.uid}")
             self.normalized = True
         except subprocess.CalledProcessError as e:
             logger.fatal(f"Failed to normalize {self.asset}: {e}")
@@ -128,16 +201,30 @@ class AudioClip:
 
 
 class AudioTrack:
-    def __init__(self, workspace: Path | str, data_dir: Path | str, sample_rate: int):
+    def __init__(
+        self, workspace: Path | str, data_dir: Path | str, sample_rate: int, max_workers: Optional[int] = None
+    ):
+        """
+        Args:
+            workspace: Path to workspace directory
+            data_dir: Directory that clip paths are relative to
+            sample_rate: Sample rate of the audio track
+            max_workers: Maximum number of ffmpeg processes to run concurrently, defaults to the number of CPUs
+        """
         self.workspace = workspace
         self.data_dir = data_dir
         self.workspace.mkdir(parents=True, exist_ok=True)
         self.sample_rate = sample_rate
+        self.max_workers = max_workers if max_workers else os.cpu_count()
         self.clips = []
+        self._by_channel: Dict[int, List[AudioClip]] = {}
+        self._max_end = 0.0
         self.path = self.workspace / "audio.wav"
 
     def add_clip(self, clip: AudioClip):
         self.clips.append(clip)
+        self._by_channel.setdefault(clip.channel, []).append(clip)
+        self._max_end = max(self._max_end, clip._end_s)
 
     def add_clips_from_config(self, configs):
         for config in configs:
@@ -145,104 +232,218 @@ class AudioTrack:
 
     def sanity_check(self):
         # channel numbers are contiguous starting from 0
-        channels = set([clip.channel for clip in self.clips])
+        channels = self._by_channel.keys()
         assert max(channels) == len(channels) - 1, "Channels must be contiguous starting from 0"
 
         # clips within same channel do not overlap
         for channel in channels:
-            clips = sorted(
-                [clip for clip in self.clips if clip.channel == channel], key=lambda x: x.span[0]
-            )
+            clips = sorted(self._by_channel[channel], key=attrgetter("_start_s"))
             for prev_clip, clip in zip(clips[:-1], clips[1:]):
-                prev_end = timecode2seconds(prev_clip.span[1])
-                cur_start = timecode2seconds(clip.span[0])
                 assert (
-                    cur_start >= prev_end
+                    clip._start_s >= prev_clip._end_s
                 ), f"Clips {prev_clip.span} and {clip.span} must not overlap"
 
     @property
     def duration(self):
-        return max([timecode2seconds(clip.span[1]) for clip in self.clips])
+        return self._max_end
 
-    def process(self):
+    async def normalize_clips(self, clips: List[AudioClip], sem: Optional[asyncio.Semaphore] = None):
+        tasks = {asyncio.ensure_future(clip.normalize_async(sem)): clip for clip in clips}
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        # do not start the remaining clips once one has failed, and stop those that are running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            if task.exception():
+                logger.fatal(f"Failed to normalize clip {tasks[task].uid}")
+                raise task.exception()
+
+    async def prepare(self, sem: Optional[asyncio.Semaphore] = None):
+        """Check the clips, probe their assets and normalize those the mixing graph cannot read directly"""
         self.sanity_check()
-        audio_channel_paths = []
-        for channel in set([clip.channel for clip in self.clips]):
-            audio_channel_path = self.workspace / f"ch_{channel}.wav"
-            self.process_one_channel(channel, audio_channel_path)
-            audio_channel_paths.append(audio_channel_path)
-
-        channels = set([clip.channel for clip in self.clips])
-        channels_with_max_duration = set(
-            [clip.channel for clip in self.clips if timecode2seconds(clip.span[1]) == self.duration]
-        )
+        # probe distinct assets concurrently, the results are cached for building the ffmpeg commands
+        assets = set(clip.asset for clip in self.clips if clip.probe_needed)
+        await asyncio.gather(*(asyncio.to_thread(probe, asset) for asset in assets))
+        await self.normalize_clips([clip for clip in self.clips if not clip.seekable], sem)
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
-        for audio_channel_path in audio_channel_paths:
-            ffmpeg_cmd.extend(["-i", audio_channel_path.as_posix()])
+    def pipeline_cmds(self, output: Path, stream: bool = False, duration: Optional[float] = None) -> List[List[str]]:
+        """
+        Build ffmpeg commands that mix the track through named pipes, the track must have been prepared. The
+        commands have to run at the same time, see vmps.exec.run_pipeline.
 
-        filter_complex = "".join(
-            f"[{c}:a]anull[a{c}];" if c in channels_with_max_duration else f"[{c}:a]apad[a{c}];"
-            for c in channels
-        )
+        Args:
+            output: Path to write the audio track to
+            stream: Write the track as a streamable NUT file rather than wav, e.g. when output is a named pipe
+            duration: Duration to pad the track to with silence, defaults to the duration of the track
+        """
+        channels = sorted(self._by_channel)
 
-        num_channels = len(audio_channel_paths)
-        filter_complex += (
-            "".join(
-                f"[a{i}]"
-                for i in list(channels - channels_with_max_duration)
-                + list(channels_with_max_duration)
+        ffmpeg_cmds = []
+        channel_inputs = []
+        for channel in channels:
+            unmixed_path = self.unmixed_channel_path(channel)
+            if unmixed_path:
+                channel_inputs.append(["-i", unmixed_path.as_posix()])
+                continue
+            audio_channel_path = self.workspace / f"ch_{channel}.pcm"
+            audio_channel_path.unlink(missing_ok=True)
+            os.mkfifo(audio_channel_path)
+            ffmpeg_cmds.append(self.mix_channel_cmd(channel, audio_channel_path, raw=True))
+            channel_inputs.append(
+                ["-f", "f32le", "-ar", str(self.sample_rate), "-ac", "1", "-i", audio_channel_path.as_posix()]
             )
-            + f"join=inputs={num_channels}:channel_layout={num_channels}c[out]"
-        )
+        ffmpeg_cmds.append(self.join_channels_cmd(channel_inputs, output, stream=stream, duration=duration))
+        return ffmpeg_cmds
 
-        ffmpeg_cmd.extend(["-filter_complex", filter_complex])
-        ffmpeg_cmd.extend(["-map", "[out]"])  # Set output to match number of channels
-        ffmpeg_cmd.extend(["-ar", str(self.sample_rate)])  # Set sample rate
-        ffmpeg_cmd.append(self.path.as_posix())
+    def process(self):
+        asyncio.run(self.process_async())
+
+    async def process_async(self):
+        sem = asyncio.Semaphore(self.max_workers)
+        await self.prepare(sem)
+
+        if hasattr(os, "mkfifo"):
+            # stream each channel into the join through a named pipe rather than an intermediate file, all
+            # processes of the pipeline have to run at the same time so max_workers does not apply here
+            ffmpeg_cmds = self.pipeline_cmds(self.path)
+            try:
+                logger.info(f"Processing audio track: {' | '.join(' '.join(cmd) for cmd in ffmpeg_cmds)}")
+                await run_pipeline(ffmpeg_cmds)
+            except subprocess.CalledProcessError as e:
+                raise ValueError(f"Failed to process audio track: {e}")
+            return
+
+        # channels are independent of each other, so mix them concurrently
+        audio_channel_paths = []
+        mixes = []
+        for channel in sorted(self._by_channel):
+            audio_channel_path = self.unmixed_channel_path(channel)
+            if not audio_channel_path:
+                audio_channel_path = self.workspace / f"ch_{channel}.wav"
+                mixes.append(self.process_one_channel(channel, audio_channel_path, sem))
+            audio_channel_paths.append(audio_channel_path)
+        await asyncio.gather(*mixes)
 
+        ffmpeg_cmd = self.join_channels_cmd([["-i", path.as_posix()] for path in audio_channel_paths], self.path)
         try:
             logger.info(f"Processing audio track: {' '.join(ffmpeg_cmd)}")
-            subprocess.run(ffmpeg_cmd, check=True)
+            await run(ffmpeg_cmd, sem)
         except subprocess.CalledProcessError as e:
             raise ValueError(f"Failed to process audio track: {e}")
 
-    def process_one_channel(self, channel: int, audio_channel_path: Path):
-        clips = [clip for clip in self.clips if clip.channel == channel]
-        for clip in clips:
-            try:
-                clip.normalize()
-            except:
-                logger.fatal(f"Failed to normalize clip {clip.uid}")
-                raise
+    def unmixed_channel_path(self, channel: int) -> Optional[Path]:
+        """Path of a file that can be used as the channel as is, if the channel needs no mixing"""
+        clips = self._by_channel[channel]
+        if len(clips) != 1:
+            return None
+        clip = clips[0]
+        if clip.sample_rate != self.sample_rate or clip._start_s != 0:
+            return None
+        if clip.normalized:
+            return clip.path
+        if clip.passthrough:
+            return clip.asset
+        return None
+
+    def join_channels_cmd(
+        self, channel_inputs: List[List[str]], output: Path, stream: bool = False, duration: Optional[float] = None
+    ) -> List[str]:
+        """
+        Args:
+            channel_inputs: ffmpeg input options (ending with "-i <path>") of each channel, in channel order
+            output: Path to write the audio track to
+            stream: Write the track as a streamable NUT file rather than wav, e.g. when output is a named pipe
+            duration: Duration to pad the track to with silence, defaults to the duration of the track
+        """
+        channels = sorted(self._by_channel)
+        ends = {c: max(clip._end_s for clip in self._by_channel[c]) for c in channels}
+        channels_with_max_duration = [c for c in channels if ends[c] == self.duration]
+        padded_channels = [c for c in channels if ends[c] != self.duration]
+        # the join ends with its first input, so pad every channel with silence and trim it to the same number of
+        # samples. It then reads each channel to the end, and no channel is left writing into a closed named pipe
+        num_samples = round((duration if duration else self.duration) * self.sample_rate)
+
+        ffmpeg_cmd = list(FFMPEG_STRICT)
+        for channel_input in channel_inputs:
+            ffmpeg_cmd.extend(channel_input)
+
+        filter_complex = io.StringIO()
+        for c in channels:
+            filter_complex.write(f"[{c}:a]apad=whole_len={num_samples},atrim=end_sample={num_samples}[a{c}];")
+        for c in padded_channels + channels_with_max_duration:
+            filter_complex.write(f"[a{c}]")
+        num_channels = len(channel_inputs)
+        filter_complex.write(f"join=inputs={num_channels}:channel_layout={num_channels}c[out]")
+        filter_complex = filter_complex.getvalue()
+
+        ffmpeg_cmd.extend(["-filter_complex", filter_complex])
+        ffmpeg_cmd.extend(["-map", "[out]"])  # Set output to match number of channels
+        ffmpeg_cmd.extend(["-ar", str(self.sample_rate)])  # Set sample rate
+        if stream:
+            ffmpeg_cmd.extend(["-c:a", "pcm_s16le", "-f", "nut"])
+        ffmpeg_cmd.append(output.as_posix())
+        return ffmpeg_cmd
+
+    def mix_channel_cmd(self, channel: int, audio_channel_path: Path, raw: bool = False) -> List[str]:
+        """
+        Args:
+            channel: Channel number
+            audio_channel_path: Path to write the mixed channel to
+            raw: Write raw mono float samples without a container, e.g. when writing to a pipe
+        """
+        clips = self._by_channel[channel]
+        # clips are cut and resampled within the mixing graph, only assets ffmpeg cannot seek in are
+        # normalized to intermediate files beforehand, see prepare
 
         inputs = []
         filters = []
         for i, clip in enumerate(clips):
-            start_time = int(1000 * timecode2seconds(clip.span[0]))
-            inputs += ["-i", clip.path.as_posix()]
-            delay_filter = f"[{i}:a]adelay={start_time}|{start_time}[a{i}]"
-            filters.append(delay_filter)
-
-        filter_complex = (
-            "; ".join(filters)
-            + f"; {''.join(f'[a{i}]' for i in range(len(clips)))}amix=inputs={len(clips)}:normalize=0"
-        )
+            start_time = int(1000 * clip._start_s)
+            if clip.normalized:
+                inputs += ["-i", clip.path.as_posix()]
+                clip_filters = []
+            else:
+                input_args, clip_filters = clip.ffmpeg_args()
+                inputs += input_args
+            if start_time > 0:
+                clip_filters.append(f"adelay={start_time}|{start_time}")
+            filters.append(f"[{i}:a]{','.join(clip_filters) or 'anull'}[a{i}]")
+
+        if len(clips) == 1:
+            # nothing to mix, the output is just the delayed clip
+            filter_complex = filters[0].removesuffix("[a0]")
+        else:
+            filter_complex = (
+                "; ".join(filters)
+                + f"; {''.join(f'[a{i}]' for i in range(len(clips)))}amix=inputs={len(clips)}:normalize=0"
+            )
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
+        ffmpeg_cmd = list(FFMPEG_STRICT)
         ffmpeg_cmd.extend(inputs)
         ffmpeg_cmd.extend(["-filter_complex", filter_complex])
         ffmpeg_cmd.extend(["-ar", str(self.sample_rate)])
+        if raw:
+            ffmpeg_cmd.extend(["-f", "f32le", "-ac", "1"])
         ffmpeg_cmd.append(audio_channel_path.as_posix())
+        return ffmpeg_cmd
 
+    async def process_one_channel(
+        self, channel: int, audio_channel_path: Path, sem: Optional[asyncio.Semaphore] = None
+    ):
+        ffmpeg_cmd = self.mix_channel_cmd(channel, audio_channel_path)
         try:
             logger.info(ffmpeg_cmd)
-            subprocess.run(ffmpeg_cmd, check=True)
+            await run(ffmpeg_cmd, sem)
         except subprocess.CalledProcessError as e:
             raise ValueError(f"Failed to process channel {channel} of audio track: {e}")
 
 
 if __name__ == "__main__":
+    import yaml
+
     logging.basicConfig(level=logging.INFO)
     path_to_config = Path("./example/config.yaml").absolute()
     workspace = Path("./workspace/example/audio").absolute()
@@ -0,0 +1,54 @@
+import asyncio
+import contextlib
+import logging
+import shlex
+import subprocess
+from typing import List, Optional
+
+logger = logging.getLogger("vmps")
+
+
+async def run(cmd: List[str], sem: Optional[asyncio.Semaphore] = None, description: Optional[str] = None):
+    """
+    Run a command, raise subprocess.CalledProcessError if it fails. The command is killed if the caller is cancelled.
+
+    Args:
+        cmd: Command to run
+        sem: Optional semaphore limiting how many commands run at the same time
+        description: Optional description to log the command with, once it actually starts
+    """
+    async with sem if sem else contextlib.nullcontext():
+        if description:
+            logger.info(f"{description}: {shlex.join(cmd)}")
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL)
+        try:
+            returncode = await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+async def run_pipeline(cmds: List[List[str]]):
+    """
+    Run commands that stream into each other (e.g. through named pipes) at the same time.
+    If any of them fails, the others are killed and subprocess.CalledProcessError is raised.
+    """
+    procs = []
+    try:
+        for cmd in cmds:
+            procs.append(await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL))
+        waiters = {asyncio.ensure_future(proc.wait()): cmd for proc, cmd in zip(procs, cmds)}
+        pending = set(waiters)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in done:
+                if waiter.result() != 0:
+                    raise subprocess.CalledProcessError(waiter.result(), waiters[waiter])
+    finally:
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
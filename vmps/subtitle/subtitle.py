@@ -2,7 +2,6 @@ import logging
 from pathlib import Path
 from typing import Dict, List, Tuple
 from uuid import uuid4
-import yaml
 
 logger = logging.getLogger("vmps")
 
@@ -13,6 +12,33 @@ class Style:
     Note that for bool parameters: -1 denotes true and 0 denotes false
     """
 
+    __slots__ = (
+        "name",
+        "fontname",
+        "fontsize",
+        "primary_colour",
+        "secondary_colour",
+        "outline_colour",
+        "back_colour",
+        "bold",
+        "italic",
+        "underline",
+        "strikeout",
+        "scale_x",
+        "scale_y",
+        "spacing",
+        "angle",
+        "border_style",
+        "outline",
+        "shadow",
+        "alignment",
+        "margin_l",
+        "margin_r",
+        "margin_v",
+        "encoding",
+        "_rendered",
+    )
+
     def __init__(
         self,
         fontname: str = "Arial",
@@ -61,26 +87,66 @@ class Style:
         self.margin_r = margin_r
         self.margin_v = margin_v
         self.encoding = encoding
+        # styles are not modified after creation, so the style line is rendered once
+        self._rendered = f"Style: {self.name}, {self.fontname}, {self.fontsize}, {self.primary_colour}, {self.secondary_colour}, {self.outline_colour}, {self.back_colour}, {self.bold}, {self.italic}, {self.underline}, {self.strikeout}, {self.scale_x}, {self.scale_y}, {self.spacing}, {self.angle}, {self.border_style}, {self.outline}, {self.shadow}, {self.alignment}, {self.margin_l}, {self.margin_r}, {self.margin_v}, {self.encoding}"
 
     def __str__(self):
-        return f"Style: {self.name}, {self.fontname}, {self.fontsize}, {self.primary_colour}, {self.secondary_colour}, {self.outline_colour}, {self.back_colour}, {self.bold}, {self.italic}, {self.underline}, {self.strikeout}, {self.scale_x}, {self.scale_y}, {self.spacing}, {self.angle}, {self.border_style}, {self.outline}, {self.shadow}, {self.alignment}, {self.margin_l}, {self.margin_r}, {self.margin_v}, {self.encoding}"
+        return self._rendered
+
+    def _key(self):
+        """All style parameters except the name"""
+        return (
+            self.fontname,
+            self.fontsize,
+            self.primary_colour,
+            self.secondary_colour,
+            self.outline_colour,
+            self.back_colour,
+            self.bold,
+            self.italic,
+            self.underline,
+            self.strikeout,
+            self.scale_x,
+            self.scale_y,
+            self.spacing,
+            self.angle,
+            self.border_style,
+            self.outline,
+            self.shadow,
+            self.alignment,
+            self.margin_l,
+            self.margin_r,
+            self.margin_v,
+            self.encoding,
+        )
 
     def __hash__(self):
-        return hash(str(self).split(",", maxsplit=1)[1])
+        return hash(self._key())
 
     def __eq__(self, other):
-        return self.__hash__() == other.__hash__()
+        if not isinstance(other, Style):
+            return NotImplemented
+        return self._key() == other._key()
 
 
 class Subtitle:
     def __init__(self, workspace: Path | str):
         self.workspace = Path(workspace)
         self.styles: List[Style] = []
-        self.styles.append(Style())
-        self.clips: List[str] = []
+        self._style_index: Dict[Style, Style] = {}
+        self.add_style(Style())
+        # (layer, start, end, style name, text) of each dialogue line
+        self.clips: List[Tuple[int, str, str, str, str]] = []
         self.workspace.mkdir(parents=True, exist_ok=True)
         self.path = workspace / "subtitle.ass"
 
+    def add_style(self, style: Style) -> Style:
+        """Add a style unless an identical one exists, returns the style to refer to"""
+        if style not in self._style_index:
+            self._style_index[style] = style
+            self.styles.append(style)
+        return self._style_index[style]
+
     def add_clip(
         self,
         uid: str,
@@ -103,11 +169,8 @@ class Subtitle:
             logger.fatal("Fail to make style for subtitle {uid}")
             raise
 
-        if style not in self.styles:
-            self.styles.append(style)
-        else:
-            style = next(s for s in self.styles if s == style)
-        self.clips.append(f"Dialogue: {layer},{span[0]},{span[1]},{style.name},,0,0,0,,{text}")
+        style = self.add_style(style)
+        self.clips.append((layer, span[0], span[1], style.name, text))
 
     def add_clips_from_config(self, configs):
         for config in configs:
@@ -115,7 +178,7 @@ class Subtitle:
 
     def process(self):
         styles = "\n".join(str(style) for style in self.styles)
-        clips = "\n".join(self.clips)
+        clips = "\n".join("Dialogue: %s,%s,%s,%s,,0,0,0,,%s" % clip for clip in self.clips)
         content = f"""
 [Script Info]
 ScriptType: v4.00+
@@ -131,6 +194,8 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         self.path.write_text(content)
 
 if __name__ == "__main__":
+    import yaml
+
     logging.basicConfig(level=logging.INFO)
     path_to_config = Path("./example/config.yaml").absolute()
     workspace = Path("./workspace/example/subtitle").absolute()
@@ -1,15 +1,21 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
 import logging
+import os
 import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict
-
-import yaml
+from typing import Dict, Optional
 
 from vmps.audio.track import AudioClip, AudioTrack
 from vmps.video.track import VideoClip, VideoTrack
 from vmps.subtitle.subtitle import Subtitle
+from vmps.exec import run_pipeline
+from vmps.utils import FFMPEG_STRICT, load_probe_cache, save_probe_cache
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.WARNING
@@ -17,10 +23,25 @@ logging.basicConfig(
 logger = logging.getLogger("vmps")
 
 class VMPSTask:
-    def __init__(self, data_dir, config: Dict):
-        self.workspace = Path(tempfile.TemporaryDirectory().name)
-        self.workspace.mkdir(parents=True, exist_ok=True)
+    def __init__(self, data_dir, config: Dict, workspace: Optional[Path | str] = None):
+        """
+        Args:
+            data_dir: Directory that paths in the config are relative to
+            config: Task config, see example/config.yaml
+            workspace: Directory for intermediate files. Reusing it across runs keeps the ffprobe results of
+                the assets. Defaults to a temporary directory that is removed on exit.
+        """
+        if workspace:
+            self.workspace = Path(workspace)
+            self.workspace.mkdir(parents=True, exist_ok=True)
+        else:
+            self.workspace = Path(tempfile.mkdtemp(prefix="vmps-"))
+            atexit.register(shutil.rmtree, self.workspace, ignore_errors=True)
+        self.probe_cache = self.workspace / ".probe_cache.json"
+        load_probe_cache(self.probe_cache)
         self.output = Path(data_dir) / config["output"]
+        # x264 preset of the final encode, trading compression for speed
+        self.preset = config.get("preset", "veryfast")
         if "video" in config:
             self.video_track = VideoTrack(self.workspace / "video", data_dir, **config["video"]["meta"])
             self.video_track.add_clips_from_config(config["video"]["clips"])
@@ -48,28 +69,55 @@ class VMPSTask:
 
     def process(self):
         self.sanity_check()
-        if self.video_track:
-            self.video_track.process()
-        if self.audio_track:
-            self.audio_track.process()
-        if self.subtitle:
-            self.subtitle.process()
+        # stream the audio track straight into the final mux through a named pipe instead of writing audio.wav
+        stream_audio = self.video_track and self.audio_track and hasattr(os, "mkfifo")
+        # tracks do not depend on each other and write to separate directories, so process them concurrently
+        tracks = [track for track in (self.video_track, self.audio_track, self.subtitle) if track]
+        with ThreadPoolExecutor(max_workers=max(len(tracks), 1)) as executor:
+            futures = []
+            for track in tracks:
+                if stream_audio and track is self.audio_track:
+                    audio_path = self.workspace / "audio.fifo"
+                    audio_path.unlink(missing_ok=True)
+                    os.mkfifo(audio_path)
+                    futures.append(executor.submit(asyncio.run, self.audio_track.prepare()))
+                else:
+                    futures.append(executor.submit(track.process))
+        for future in futures:
+            future.result()
+        save_probe_cache(self.probe_cache)
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
+        ffmpeg_cmd = list(FFMPEG_STRICT)
         if self.video_track:
             ffmpeg_cmd.extend(["-i", self.video_track.path.as_posix()])
             if self.audio_track:
-                ffmpeg_cmd.extend(["-i", self.audio_track.path.as_posix()])
-                ffmpeg_cmd.extend(["-filter_complex", f"[1:a]apad,atrim=duration={self.video_track.duration}[aud]"])
+                if not stream_audio:
+                    audio_path = self.audio_track.path
+                ffmpeg_cmd.extend(["-i", audio_path.as_posix()])
                 ffmpeg_cmd.extend(["-map", "0:v"])
-                ffmpeg_cmd.extend(["-map", "[aud]"])
-                ffmpeg_cmd.extend(["-c:v", "libx264"])
+                if stream_audio:
+                    # the audio pipeline pads the track to the video duration itself, so the mux reads the named
+                    # pipe to the end instead of closing it while the join still writes
+                    ffmpeg_cmd.extend(["-map", "1:a"])
+                else:
+                    ffmpeg_cmd.extend(["-filter_complex", f"[1:a]apad,atrim=duration={self.video_track.duration}[aud]"])
+                    ffmpeg_cmd.extend(["-map", "[aud]"])
                 ffmpeg_cmd.extend(["-c:a", "aac"])
+            # the video is encoded again, with or without an audio track
+            ffmpeg_cmd.extend(["-c:v", "libx264"])
+            ffmpeg_cmd.extend(["-preset", self.preset])
             if self.subtitle:
                 ffmpeg_cmd.extend(["-vf", f"subtitles={self.subtitle.path.as_posix()}"])
             ffmpeg_cmd.append(self.output.as_posix())
-            logger.info(f"Excuting: {' '.join(ffmpeg_cmd)}")
-            subprocess.run(ffmpeg_cmd, check=True)
+            if stream_audio:
+                # the audio pipeline writes into the named pipe that the final mux reads from
+                audio_cmds = self.audio_track.pipeline_cmds(audio_path, stream=True, duration=self.video_track.duration)
+                ffmpeg_cmds = audio_cmds + [ffmpeg_cmd]
+                logger.info(f"Excuting: {' | '.join(' '.join(cmd) for cmd in ffmpeg_cmds)}")
+                asyncio.run(run_pipeline(ffmpeg_cmds))
+            else:
+                logger.info(f"Excuting: {' '.join(ffmpeg_cmd)}")
+                subprocess.run(ffmpeg_cmd, check=True)
         elif self.audio_track:
             shutil.move(self.audio_track.path, self.output)
         else:
@@ -79,6 +127,8 @@ class VMPSTask:
         shutil.rmtree(self.workspace)
 
 if __name__ == "__main__":
+    import yaml
+
     with open("example/config.yaml") as f:
         config = yaml.safe_load(f)
     task = VMPSTask(config)
@@ -1,6 +1,30 @@
+import functools
+import json
+import os
+import shutil
+import subprocess
 from datetime import timedelta
+from pathlib import Path
+from typing import Dict
 
+# common ffmpeg options: overwrite outputs, only report warnings, never read the terminal (several ffmpeg processes
+# may run at the same time) and skip the banner and progress output
+FFMPEG_BASE = ["ffmpeg", "-y", "-v", "warning", "-nostdin", "-hide_banner", "-nostats"]
+# FFMPEG_BASE that also stops at the first error. Not for stream copies of video clips, which can report errors
+# ffmpeg recovers from
+FFMPEG_STRICT = [*FFMPEG_BASE, "-xerror"]
 
+# stream fields read from probe results, ffprobe leaves out everything else (format, tags, dispositions, ...)
+PROBE_ENTRIES = (
+    "stream=codec_type,codec_name,profile,pix_fmt,extradata_hash,width,height,sample_aspect_ratio,r_frame_rate,"
+    "duration,bit_rate,sample_rate,channels"
+)
+
+# probe results that survive between runs, keyed by json-encoded (path, size, mtime, PROBE_ENTRIES)
+_persistent_probes: Dict[str, Dict] = {}
+
+
+@functools.lru_cache(maxsize=None)
 def timecode2seconds(timecode):
     """Convert hh:mm:ss.sss timecode to seconds."""
     timecode = timecode.split(":")
@@ -15,3 +39,63 @@ def seconds2timecode(seconds):
 
     timecode = f"{hours:02}:{minutes:02}:{seconds:02}.{int(delta.microseconds / 1000):03}"
     return timecode
+
+
+def probe(path):
+    """
+    Like ffmpeg.probe, but only with the stream fields in PROBE_ENTRIES, and the result is cached until the file
+    changes. Do not modify the returned dict. Raises ffmpeg.Error if ffprobe fails, same as ffmpeg.probe.
+    """
+    path = Path(path)
+    stat = path.stat()
+    return _probe(path.as_posix(), stat.st_size, stat.st_mtime)
+
+
+@functools.lru_cache(maxsize=512)
+def _probe(path: str, size: int, mtime: float):
+    key = json.dumps([path, size, mtime, PROBE_ENTRIES])
+    if key not in _persistent_probes:
+        # the hash tells apart codec parameters of the same codec and profile, see VideoClip.codec_parameters
+        ffprobe_cmd = ["ffprobe", "-v", "error", "-show_data_hash", "sha256", "-show_entries", PROBE_ENTRIES]
+        result = subprocess.run([*ffprobe_cmd, "-of", "json", path], capture_output=True)
+        if result.returncode != 0:
+            import ffmpeg
+
+            raise ffmpeg.Error("ffprobe", result.stdout, result.stderr)
+        _persistent_probes[key] = json.loads(result.stdout)
+    return _persistent_probes[key]
+
+
+def link_or_copy(src: Path, dst: Path):
+    """
+    Make dst a copy of src as cheaply as possible: a hardlink, a reflink (copy-on-write clone on filesystems such as
+    Btrfs or XFS), or a full copy as the last resort. dst is replaced if it exists.
+    """
+    Path(dst).unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            # FICLONE is only exposed by the fcntl module from Python 3.12
+            fcntl.ioctl(dst_file.fileno(), getattr(fcntl, "FICLONE", 0x40049409), src_file.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def load_probe_cache(cache_file: Path):
+    """Load probe results saved by a previous run with save_probe_cache."""
+    cache_file = Path(cache_file)
+    if cache_file.exists():
+        _persistent_probes.update(json.loads(cache_file.read_text()))
+
+
+def save_probe_cache(cache_file: Path):
+    Path(cache_file).write_text(json.dumps(_persistent_probes))
+
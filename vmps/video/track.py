@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import asyncio
+import io
 import os
-import shutil
 import logging
+import shlex
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
-import ffmpeg
-import filetype
-import yaml
-
-from vmps.utils import timecode2seconds
-from vmps.video.utils import get_video_codec
+from vmps.exec import run
+from vmps.utils import FFMPEG_BASE, link_or_copy, probe, timecode2seconds
+from vmps.video.utils import (
+    NVDEC_CODECS,
+    VAAPI_CODECS,
+    VAAPI_DEVICE,
+    detect_hwaccel,
+    get_video_codec,
+    is_image,
+    is_video,
+    parse_bitrate,
+)
 
 logger = logging.getLogger("vmps")
 
@@ -60,6 +70,9 @@ class VideoClip:
         self.asset = data_dir / Path(path)
         self.uid = uid
         self.span = span
+        # span boundaries in seconds, used wherever the clip is placed on the timeline
+        self.start_sec = timecode2seconds(span[0])
+        self.end_sec = timecode2seconds(span[1])
         self.clip = clip
         self.width = width if width else track.width
         self.height = height if height else track.height
@@ -74,7 +87,8 @@ class VideoClip:
         assert self.codec, f"Failed to get codec for {self.asset}"
 
         self.normalized = False
-        self.path = (self.workspace / f"{uuid4().hex}").with_suffix(self.asset.suffix)
+        # normalized clips are encoded with the track's intermediate encoder, see VideoTrack.intermediate_encoder_args
+        self.path = (self.workspace / f"{uuid4().hex}").with_suffix(".mp4")
         self.workspace.mkdir(parents=True, exist_ok=True)
 
         self.track = track
@@ -82,189 +96,455 @@ class VideoClip:
 
     @property
     def duration(self):
-        return round(timecode2seconds(self.span[1]) - timecode2seconds(self.span[0]), 4)
+        return round(self.end_sec - self.start_sec, 4)
 
-    def normalize(self):
-        if self.normalized:
-            return
+    @property
+    def passthrough(self):
+        """Whether the asset can be used as the normalized clip as is: a whole video already at the clip's size, frame
+        rate and duration, within the clip's bitrate"""
+        if self.clip or not is_video(self.asset):
+            return False
+        stream = next(stream for stream in probe(self.asset)["streams"] if stream["codec_type"] == "video")
+        return (
+            int(stream["width"]) == self.width
+            and int(stream["height"]) == self.height
+            and stream.get("sample_aspect_ratio", "1:1") in ("1:1", "0:1")
+            and Fraction(stream["r_frame_rate"]) == self.fps
+            and round(float(stream.get("duration", 0)), 4) == self.duration
+            and int(stream.get("bit_rate") or 0) <= parse_bitrate(self.bitrate)
+        )
 
-        expected_duration = round(timecode2seconds(self.span[1]) - timecode2seconds(self.span[0]), 4)
-        if filetype.is_image(self.asset):
-            self.path = self.path.with_suffix(".mp4")
-            ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
-            ffmpeg_cmd.extend(["-loop", "1"])
-            ffmpeg_cmd.extend(["-t", str(expected_duration)])
-            ffmpeg_cmd.extend(["-i", self.asset.as_posix()])
-            ffmpeg_cmd.extend(["-vf", f"scale={self.width}:{self.height}"])
-            ffmpeg_cmd.extend(["-r", str(self.fps)])
-            ffmpeg_cmd.extend(["-b:v", self.bitrate])
-            ffmpeg_cmd.append(self.path.as_posix())
-            try:
-                logger.info(f"Normalizing {self.uid}: {' '.join(ffmpeg_cmd)}")
-                subprocess.run(ffmpeg_cmd, check=True)
-                self.normalized = True
-            except subprocess.CalledProcessError as e:
-                raise ValueError(f"Failed to generate normalized video: {e}")
-            return
+    @property
+    def codec_parameters(self):
+        """Stream layout of the asset and the codec parameters of its video stream, assets can only be stream-copied
+        into one file if these are the same"""
+        streams = probe(self.asset)["streams"]
+        stream = next(stream for stream in streams if stream["codec_type"] == "video")
+        video_parameters = tuple(stream.get(key) for key in ("codec_name", "profile", "pix_fmt", "extradata_hash"))
+        return tuple(stream["codec_type"] for stream in streams), video_parameters
+
+    def link(self):
+        """Use the asset as the normalized clip as is, see passthrough"""
+        logger.info(f"Linking {self.uid}: {self.asset} is already normalized")
+        self.path = self.path.with_suffix(self.asset.suffix)
+        link_or_copy(self.asset, self.path)
+        self.normalized = True
+
+    def ffmpeg_args(self, seek: bool = True) -> Tuple[List[str], List[str]]:
+        """
+        Build the ffmpeg arguments that cut, scale and extend the asset to this clip.
 
-        assert filetype.is_video(self.asset), f"Unsupported file type: {self.asset}"
+        Args:
+            seek (bool, optional): Cut the asset with input options, otherwise with a trim filter so that clips of the
+                same asset can share one input. Defaults to True.
+
+        Returns:
+            Input options of the asset (ending with "-i <asset>") and the filters to apply to its video stream
+        """
+        expected_duration = self.duration
+        # tpad needs the frame rate of its input, so reset the timestamps only at the end of the chain
+        filters = [f"scale={self.width}:{self.height}", "setsar=1"]
+        if is_image(self.asset):
+            filters.append("setpts=PTS-STARTPTS")
+            input_args = ["-loop", "1", "-framerate", str(self.fps), "-t", str(expected_duration)]
+            return [*input_args, "-i", self.asset.as_posix()], filters
+
+        assert is_video(self.asset), f"Unsupported file type: {self.asset}"
+
+        import ffmpeg
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning", "-i", self.asset.as_posix()]
         try:
-            actual_duration = float(ffmpeg.probe(self.asset.as_posix())["streams"][0]["duration"])
+            # cached since the constructor probed the asset for its codec
+            asset_duration = float(probe(self.asset)["streams"][0]["duration"])
         except ffmpeg.Error as e:
             logger.error(e.stderr.decode("utf-8"))
             raise e
 
-        if self.clip:
-            if self.clip[1]:
-                ffmpeg_cmd.extend(["-to", self.clip[1]])
-                actual_duration = timecode2seconds(self.clip[1])
-            if self.clip[0]:
-                ffmpeg_cmd.extend(["-ss", self.clip[0]])
-                actual_duration -= timecode2seconds(self.clip[0])
-
-        vf_filters = [f"scale={self.width}:{self.height}"]
+        start = timecode2seconds(self.clip[0]) if self.clip and self.clip[0] else 0
+        end = timecode2seconds(self.clip[1]) if self.clip and self.clip[1] else asset_duration
+        actual_duration = round(end - start, 4)
         if actual_duration < expected_duration:
             extension_duration = round(expected_duration - actual_duration, 4)
             if self.extension == "repeat_first":
-                vf_filters.append(f"tpad=start_duration={extension_duration}:start_mode=clone, fps={self.fps}")
+                filters.append(f"tpad=start_duration={extension_duration}:start_mode=clone")
             elif self.extension == "repeat_last":
-                vf_filters.append(f"tpad=stop_duration={extension_duration}:stop_mode=clone, fps={self.fps}")
+                filters.append(f"tpad=stop_duration={extension_duration}:stop_mode=clone")
             else:
                 raise NotImplementedError(f"Extension method '{self.extension}' is not implemented")
 
         elif actual_duration > expected_duration:
             if self.shrink == "trim_start":
-                seek_start_time = round(actual_duration - expected_duration, 4)
-                ffmpeg_cmd.extend(["-ss", str(seek_start_time)])
+                start = end - expected_duration
             elif self.shrink == "trim_end":
-                ffmpeg_cmd.extend(["-to", str(expected_duration)])
+                end = start + expected_duration
             else:
                 raise NotImplementedError(f"Shrink method '{self.shrink}' is not implemented")
+        filters.extend([f"fps={self.fps}", "setpts=PTS-STARTPTS"])
+        if not seek:
+            if start or end < asset_duration:
+                filters.insert(0, f"trim=start={round(start, 4)}:end={round(end, 4)}")
+            start, end = 0, asset_duration
+
+        input_args = []
+        if self.track.hwaccel == "cuda" and self.codec in NVDEC_CODECS:
+            # decode on the GPU, the filters above run on the CPU so frames are copied back to system memory
+            input_args += ["-hwaccel", "cuda"]
+        elif self.track.hwaccel == "vaapi" and self.codec in VAAPI_CODECS:
+            input_args += ["-hwaccel", "vaapi"]
+        if start:
+            input_args += ["-ss", str(round(start, 4))]
+        if end < asset_duration:
+            input_args += ["-t", str(round(end - start, 4))]
+        return [*input_args, "-i", self.asset.as_posix()], filters
+
+    def normalize(self, threads: Optional[int] = None):
+        asyncio.run(self.normalize_async(threads))
+
+    async def normalize_async(self, threads: Optional[int] = None, sem: Optional[asyncio.Semaphore] = None):
+        """
+        Args:
+            threads (Optional[int], optional): Threads for ffmpeg to use, ffmpeg decides if not set. Defaults to None.
+            sem (Optional[asyncio.Semaphore], optional): Semaphore limiting the concurrent ffmpeg processes.
+                Defaults to None.
+        """
+        if self.normalized:
+            return
 
-        if vf_filters:
-            ffmpeg_cmd.extend(["-vf", ",".join(vf_filters)])
-        ffmpeg_cmd.extend(["-r", str(self.fps)])
-        ffmpeg_cmd.extend(["-b:v", self.bitrate])
-        ffmpeg_cmd.extend(["-c:v", self.codec])
-        ffmpeg_cmd.append(self.path.as_posix())
+        # ffmpeg_args may have to probe the asset, which blocks
+        input_args, filters = await asyncio.to_thread(self.ffmpeg_args)
+        ffmpeg_cmd = list(FFMPEG_BASE)
+        # the filter graph runs in parallel with the decoder and encoder threads, size it the same way
+        ffmpeg_cmd += ["-filter_threads", str(threads or os.cpu_count() or 1), *input_args]
+        ffmpeg_cmd += ["-vf", ",".join(filters), "-r", str(self.fps)]
+        if threads:
+            ffmpeg_cmd += ["-threads", str(threads)]
+
+        frame_path = None
+        if is_image(self.asset):
+            # all frames of an image clip are the same, so encode a single frame and repeat it without re-encoding
+            frame_path = self.path.with_suffix(".frame.mp4")
+            # encoded like any other clip, so that the looped frame can be stream-copied next to video clips
+            ffmpeg_cmd += ["-frames:v", "1", *self.encoder_args(), frame_path.as_posix()]
+            loop_count = max(round(self.duration * self.fps), 1) - 1
+            loop_cmd = [*FFMPEG_BASE, "-stream_loop", str(loop_count)]
+            loop_cmd += ["-i", frame_path.as_posix(), "-c", "copy", self.path.as_posix()]
+            ffmpeg_cmds = [ffmpeg_cmd, loop_cmd]
+        else:
+            ffmpeg_cmds = [[*ffmpeg_cmd, *self.encoder_args(), self.path.as_posix()]]
 
         try:
-            logger.info(f"Normalizing {self.uid}: {' '.join(ffmpeg_cmd)}")
-            subprocess.run(ffmpeg_cmd, check=True)
+            for ffmpeg_cmd in ffmpeg_cmds:
+                await run(ffmpeg_cmd, sem, f"Normalizing {self.uid}")
             self.normalized = True
         except subprocess.CalledProcessError as e:
             raise ValueError(f"Failed to normalize video clip: {e}")
+        finally:
+            if frame_path:
+                frame_path.unlink(missing_ok=True)
+
+    def encoder_args(self) -> List[str]:
+        """ffmpeg output options to encode the normalized video clip with"""
+        return ["-b:v", self.bitrate, *self.track.intermediate_encoder_args()]
 
 
 class VideoTrack:
-    def __init__(self, workspace: Path | str, data_dir: Path | str, width: int, height: int, bitrate: str, fps: int):
+    def __init__(
+        self,
+        workspace: Path | str,
+        data_dir: Path | str,
+        width: int,
+        height: int,
+        bitrate: str,
+        fps: int,
+        hwaccel: Optional[str] = "auto",
+        max_workers: Optional[int] = None,
+        fuse: bool = True,
+        preset: Optional[str] = None,
+    ):
+        """
+        Args:
+            workspace (Path | str): Workspace path
+            data_dir (Path | str): Directory that clip paths are relative to
+            width (int): Width of the video
+            height (int): Height of the video
+            bitrate (str): Bitrate of the video
+            fps (int): Frames per second
+            hwaccel (Optional[str], optional): Hardware acceleration. Options: "auto" (detect), "cuda" (NVIDIA),
+                "vaapi" (Intel/AMD), None (CPU only). Defaults to "auto".
+            max_workers (Optional[int], optional): Maximum number of clips to normalize concurrently, defaults to half
+                the number of CPUs since every ffmpeg process is multi-threaded already.
+            fuse (bool, optional): Render the whole track with a single ffmpeg process that reads the assets directly,
+                instead of normalizing every clip to an intermediate file first. Defaults to True.
+            preset (Optional[str], optional): libx264 preset of the composite, e.g. "veryfast" or "slow". Defaults to
+                None, i.e. libx264's default.
+        """
         self.workspace = Path(workspace)
         self.data_dir = Path(data_dir)
         self.width = width
         self.height = height
         self.bitrate = bitrate
         self.fps = fps
+        self.hwaccel = detect_hwaccel() if hwaccel == "auto" else hwaccel
+        self.max_workers = max_workers if max_workers else max(1, (os.cpu_count() or 1) // 2)
+        self.fuse = fuse
+        self.preset = preset
         self.clips_base = []
         self.clips_overlay = []
+        # span boundaries of the base clips in seconds, in the same order as clips_base
+        self._start_sec = []
+        self._end_sec = []
         self.path = workspace / "output.mp4"
 
     def add_clip(self, clip):
         if clip.layer == 0:
             self.clips_base.append(clip)
+            self._start_sec.append(clip.start_sec)
+            self._end_sec.append(clip.end_sec)
         else:
             self.clips_overlay.append(clip)
 
     def add_clips_from_config(self, configs):
+        # probe the distinct assets concurrently, every clip probes its asset when it is created and finds the result
+        # cached. Failures are left for the clip to report
+        assets = {self.data_dir / Path(config["path"]) for config in configs}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for asset in assets:
+                executor.submit(probe, asset)
+
         for config in configs:
             VideoClip(self, self.workspace / "clips", self.data_dir, **config)
 
     @property
     def duration(self):
-        return timecode2seconds(self.clips_base[-1].span[1])
+        return max(self._end_sec)
 
     def sanity_check(self):
-        for i in range(len(self.clips_base) - 1):
-            if self.clips_base[i].span[1] != self.clips_base[i + 1].span[0]:
+        for i, (end, start) in enumerate(zip(self._end_sec, self._start_sec[1:])):
+            if end != start:
                 raise ValueError(
-                    "Layer 0 clips are not continuous: {self.clips_base[i].span[1]} != {self.clips_base[i + 1].span[0]}"
+                    f"Layer 0 clips are not continuous: {self.clips_base[i].span[1]} != {self.clips_base[i + 1].span[0]}"
                 )
 
+        track_end = self._end_sec[-1]
         for clip in self.clips_overlay:
-            if clip.span[1] > self.clips_base[-1].span[1]:
+            if clip.end_sec > track_end:
                 raise ValueError(f"Clip {clip.asset} is out of range: {clip.span[1]} > {self.clips_base[-1].span[1]}")
 
     def process(self):
-        self.clips_base.sort(key=lambda x: x.span[0])
+        # sort the base clips and their span boundaries together, by start time
+        order = sorted(range(len(self.clips_base)), key=self._start_sec.__getitem__)
+        self.clips_base = [self.clips_base[i] for i in order]
+        self._start_sec = [self._start_sec[i] for i in order]
+        self._end_sec = [self._end_sec[i] for i in order]
         self.clips_overlay.sort(key=lambda x: x.layer)
         assert self.clips_base, "No base clips found"
-        assert (
-            timecode2seconds(self.clips_base[0].span[0]) == 0
-        ), f"base clips should start at 00:00:00.000: {self.clips_base[0].span[0]}"
+        assert self._start_sec[0] == 0, f"base clips should start at 00:00:00.000: {self.clips_base[0].span[0]}"
         self.sanity_check()
+        if self.fuse:
+            self.process_fused()
+            return
+
+        self.link_passthrough_clips()
+        # video clips cut from the same asset are normalized together so that the asset is decoded only once
+        batches = {}
         for clip in self.clips_base + self.clips_overlay:
-            try:
-                clip.normalize()
-            except:
-                logger.fatal(f"Failed to normalize clip {clip.uid}")
-                raise
-
-        # make base video
-        base_video_path = self.workspace / "base.mp4"
-        concat_demuxer = self.workspace / "base.demuxer"
-        concat_demuxer.write_text("\n".join([f"file '{clip.path}'" for clip in self.clips_base]))
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
-        ffmpeg_cmd.extend(["-f", "concat"])
-        ffmpeg_cmd.extend(["-safe", "0"])
-        ffmpeg_cmd.extend(["-i", concat_demuxer.as_posix()])
-        ffmpeg_cmd.extend(["-c", "copy"])
-        ffmpeg_cmd.append(base_video_path.as_posix())
+            if not clip.normalized:
+                batches.setdefault(clip if is_image(clip.asset) else clip.asset, []).append(clip)
+
+        asyncio.run(self.normalize_clips(list(batches.values())))
+
+        # make base video, straight into the track output if there is nothing to overlay
+        base_video_path = self.workspace / "base.mp4" if self.clips_overlay else self.path
+        # the concat demuxer reads the list of clips from stdin, no need to write it to a file. Entries are resolved
+        # relative to the list's url, so they need an explicit file: protocol
+        concat_list = "".join(f"file 'file:{clip.path.absolute()}'\n" for clip in self.clips_base).encode()
+        ffmpeg_cmd = [*FFMPEG_BASE, "-f", "concat", "-safe", "0"]
+        ffmpeg_cmd += ["-protocol_whitelist", "file,pipe", "-i", "pipe:"]
+        # linked assets may have other streams, the base video is made of the video streams only
+        ffmpeg_cmd += ["-map", "0:v", "-c", "copy", base_video_path.as_posix()]
         try:
-            subprocess.run(ffmpeg_cmd, check=True)
+            logger.info(f"Concatenating base clips: {shlex.join(ffmpeg_cmd)}")
+            subprocess.run(ffmpeg_cmd, input=concat_list, check=True)
         except subprocess.CalledProcessError as e:
             raise ValueError(f"Failed to generate base video: {e}")
 
         if not self.clips_overlay:
-            try:
-                if not os.path.exists(base_video_path):
-                    raise FileNotFoundError(f"File {base_video_path} does not exist.")
-                shutil.copy(base_video_path, self.path)
-            except Exception as e:
-                raise ValueError(f"Failed to generate video track: {e}")
             return
 
         input_files = [base_video_path.as_posix()] + [clip.path.as_posix() for clip in self.clips_overlay]
-        filter_complex = []
-
-        overlay_chain = ""
+        filter_complex = io.StringIO()
+        overlay_chain = io.StringIO()
         overlay_video_stream = "[0:v]"
         for i, clip in enumerate(self.clips_overlay, start=1):
-            start, end = timecode2seconds(clip.span[0]), timecode2seconds(clip.span[1])
-            filter_complex.append(f"[{i}:v]setpts=PTS-STARTPTS+{start}/TB[fv{i}]")
-            overlay_chain = f"{overlay_chain}{overlay_video_stream}[fv{i}]overlay=x={clip.posX}:y={clip.posY}:enable='between(t,{start},{end})'"
+            start, end = clip.start_sec, clip.end_sec
+            filter_complex.write(f"[{i}:v]setpts=PTS-STARTPTS+{start}/TB[fv{i}];")
+            overlay_chain.write(
+                f"{overlay_video_stream}[fv{i}]overlay=x={clip.posX}:y={clip.posY}:enable='between(t,{start},{end})'"
+            )
             overlay_video_stream = f"[ov{i}]"
             if i != len(self.clips_overlay):
-                overlay_chain = f"{overlay_chain}{overlay_video_stream};"
+                overlay_chain.write(f"{overlay_video_stream};")
 
-        filter_complex_cmd = ";".join(filter_complex) + ";" + overlay_chain
+        filter_complex.write(overlay_chain.getvalue())
+        filter_complex.write(f",{self.output_filter()}")
+        filter_complex_cmd = filter_complex.getvalue()
 
-        ffmpeg_cmd = ["ffmpeg", "-y", "-v", "warning"]
+        ffmpeg_cmd = [*FFMPEG_BASE, "-filter_complex_threads", str(os.cpu_count() or 1)]
+        ffmpeg_cmd += self.device_args()
         for input_file in input_files:
-            ffmpeg_cmd.extend(["-i", input_file])
+            ffmpeg_cmd += ["-i", input_file]
+        ffmpeg_cmd += ["-filter_complex", filter_complex_cmd, *self.encoder_args(), self.path.as_posix()]
+
+        try:
+            logger.info(f"Processing video track: {shlex.join(ffmpeg_cmd)}")
+            subprocess.run(ffmpeg_cmd, check=True)
+        except subprocess.CalledProcessError as e:
+            raise ValueError(f"Failed to generate video track: {e}")
+
+    def link_passthrough_clips(self):
+        """
+        Link the assets that already match their clip instead of normalizing them, see VideoClip.passthrough. Overlay
+        clips are separate inputs of the overlay pass, but the base clips are stream-copied into one file that only
+        decodes if all of them share the same codec parameters, so either all base clips are linked or none.
+        """
+        clips = [clip for clip in self.clips_overlay if clip.passthrough]
+        if all(clip.passthrough for clip in self.clips_base):
+            if len({clip.codec_parameters for clip in self.clips_base}) == 1:
+                clips += self.clips_base
+        for clip in clips:
+            clip.link()
+
+    async def normalize_clips(self, batches: List[List[VideoClip]]):
+        """
+        Args:
+            batches (List[List[VideoClip]]): Clips to normalize, each batch with clips of the same asset
+        """
+        # batches are independent, share the cores between the ffmpeg processes normalizing them
+        sem = asyncio.Semaphore(self.max_workers)
+        threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        tasks = {asyncio.ensure_future(self.normalize_batch(clips, threads, sem)): clips for clips in batches}
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        # do not start the remaining batches once one has failed, and stop those that are running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            if task.exception():
+                logger.fatal(f"Failed to normalize clip {', '.join(clip.uid for clip in tasks[task])}")
+                raise task.exception()
+
+    async def normalize_batch(
+        self, clips: List[VideoClip], threads: Optional[int] = None, sem: Optional[asyncio.Semaphore] = None
+    ):
+        """
+        Normalize video clips of the same asset with one ffmpeg process, decoding the asset once.
+
+        Args:
+            clips (List[VideoClip]): Clips to normalize, all of the same asset
+            threads (Optional[int], optional): Threads for ffmpeg to use, ffmpeg decides if not set. Defaults to None.
+            sem (Optional[asyncio.Semaphore], optional): Semaphore limiting the concurrent ffmpeg processes.
+                Defaults to None.
+        """
+        clips = [clip for clip in clips if not clip.normalized]
+        if len(clips) <= 1:
+            for clip in clips:
+                await clip.normalize_async(threads, sem)
+            return
+
+        filter_complex = [f"[0:v]split={len(clips)}{''.join(f'[s{i}]' for i in range(len(clips)))}"]
+        # output options only apply to the output that follows them, so every output gets its own thread count
+        thread_args = ["-threads", str(threads)] if threads else []
+        output_args = []
+        for i, clip in enumerate(clips):
+            input_args, filters = await asyncio.to_thread(clip.ffmpeg_args, False)
+            filter_complex.append(f"[s{i}]{','.join(filters)}[c{i}]")
+            output_args += ["-map", f"[c{i}]", "-r", str(clip.fps), *thread_args, *clip.encoder_args()]
+            output_args.append(clip.path.as_posix())
+
+        ffmpeg_cmd = list(FFMPEG_BASE)
+        ffmpeg_cmd += ["-filter_complex_threads", str(threads or os.cpu_count() or 1), *input_args]
+        ffmpeg_cmd += ["-filter_complex", ";".join(filter_complex), *output_args]
+
+        try:
+            await run(ffmpeg_cmd, sem, f"Normalizing {', '.join(clip.uid for clip in clips)}")
+        except subprocess.CalledProcessError as e:
+            raise ValueError(f"Failed to normalize video clips: {e}")
+        for clip in clips:
+            clip.normalized = True
+
+    def intermediate_encoder_args(self) -> List[str]:
+        """
+        ffmpeg output options that every normalized clip is encoded with, whatever its asset. The base clips are
+        stream-copied into one file that keeps the codec parameters of the first clip only, so the others only decode
+        if they were encoded the same way.
+        """
+        if self.hwaccel == "cuda":
+            return ["-c:v", "h264_nvenc", "-preset", "p4", "-pix_fmt", "yuv420p"]
+        # the track is encoded again, so spend as little time as possible on the intermediates. stitchable keeps x264
+        # from adapting the parameter sets to the content of each clip
+        encoder_args = ["-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency"]
+        return [*encoder_args, "-x264-params", "stitchable=1", "-pix_fmt", "yuv420p"]
+
+    def device_args(self) -> List[str]:
+        """ffmpeg global options opening the device the composited track is encoded on"""
+        if self.hwaccel == "vaapi":
+            return ["-vaapi_device", VAAPI_DEVICE]
+        return []
+
+    def output_filter(self) -> str:
+        """Filter converting the composited frames to what the encoder takes"""
+        if self.hwaccel == "vaapi":
+            # the filters run on the CPU, upload the result to the GPU for the encoder
+            return "format=nv12,hwupload"
+        return "format=yuv420p"
+
+    def encoder_args(self) -> List[str]:
+        """ffmpeg output options to encode the composited track with"""
+        if self.hwaccel == "cuda":
+            return ["-c:v", "h264_nvenc", "-preset", "p4", "-b:v", self.bitrate]
+        if self.hwaccel == "vaapi":
+            return ["-c:v", "h264_vaapi", "-b:v", self.bitrate]
+        if self.preset:
+            return ["-c:v", "libx264", "-preset", self.preset]
+        return ["-c:v", "libx264"]
+
+    def process_fused(self):
+        """Cut, scale, concatenate and overlay all clips in one filter graph, so the base layer is encoded only once"""
+        ffmpeg_cmd = [*FFMPEG_BASE, "-filter_complex_threads", str(os.cpu_count() or 1)]
+        ffmpeg_cmd += self.device_args()
+        filter_complex = []
+        for i, clip in enumerate(self.clips_base + self.clips_overlay):
+            input_args, filters = clip.ffmpeg_args()
+            ffmpeg_cmd += input_args
+            if clip.layer != 0:
+                filters[-1] = f"setpts=PTS-STARTPTS+{clip.start_sec}/TB"
+            filter_complex.append(f"[{i}:v]{','.join(filters)}[v{i}]")
+
+        base_streams = "".join(f"[v{i}]" for i in range(len(self.clips_base)))
+        filter_complex.append(f"{base_streams}concat=n={len(self.clips_base)}:v=1:a=0[ov0]")
+        for i, clip in enumerate(self.clips_overlay, start=1):
+            start, end = clip.start_sec, clip.end_sec
+            filter_complex.append(
+                f"[ov{i - 1}][v{len(self.clips_base) + i - 1}]"
+                f"overlay=x={clip.posX}:y={clip.posY}:enable='between(t,{start},{end})'[ov{i}]"
+            )
+        filter_complex.append(f"[ov{len(self.clips_overlay)}]{self.output_filter()}[out]")
 
-        ffmpeg_cmd.extend(["-filter_complex", filter_complex_cmd])
-        ffmpeg_cmd.extend(["-c:v", "libx264"])
-        ffmpeg_cmd.append(self.path.as_posix())
+        ffmpeg_cmd += ["-filter_complex", ";".join(filter_complex), "-map", "[out]"]
+        ffmpeg_cmd += ["-r", str(self.fps), *self.encoder_args(), self.path.as_posix()]
 
         try:
-            logger.info(f"Processing video track: {' '.join(ffmpeg_cmd)}")
+            logger.info(f"Processing video track: {shlex.join(ffmpeg_cmd)}")
             subprocess.run(ffmpeg_cmd, check=True)
         except subprocess.CalledProcessError as e:
             raise ValueError(f"Failed to generate video track: {e}")
 
 
 if __name__ == "__main__":
+    import yaml
+
     logging.basicConfig(level=logging.INFO)
     path_to_config = Path("./example/config.yaml").absolute()
     workspace = Path("./workspace/example/video").absolute()
@@ -1,14 +1,88 @@
-import ffmpeg
+import functools
 import logging
+import os
+import subprocess
+from pathlib import Path
+from typing import Optional, Tuple
+
+from vmps.utils import probe
 
 logger = logging.getLogger(__name__)
 
+# codecs NVDEC can decode, with "-hwaccel cuda" ffmpeg falls back to software decoding for anything else anyway
+NVDEC_CODECS = {"av1", "h264", "hevc", "mjpeg", "mpeg1video", "mpeg2video", "mpeg4", "vc1", "vp8", "vp9"}
+# codecs VAAPI drivers commonly decode, and the render node its encoder runs on
+VAAPI_CODECS = {"av1", "h264", "hevc", "mjpeg", "mpeg2video", "vc1", "vp8", "vp9"}
+VAAPI_DEVICE = "/dev/dri/renderD128"
+# suffixes that tell images and videos apart without reading the file
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+VIDEO_EXTS = {".mp4", ".mov", ".mkv", ".webm"}
+
+
+def is_image(path) -> bool:
+    """Whether the file is an image, by its suffix if it is a known one, otherwise by its content"""
+    suffix = Path(path).suffix.lower()
+    if suffix in IMAGE_EXTS or suffix in VIDEO_EXTS:
+        return suffix in IMAGE_EXTS
+    import filetype
+
+    return filetype.is_image(path)
+
+
+def is_video(path) -> bool:
+    """Whether the file is a video, by its suffix if it is a known one, otherwise by its content"""
+    suffix = Path(path).suffix.lower()
+    if suffix in IMAGE_EXTS or suffix in VIDEO_EXTS:
+        return suffix in VIDEO_EXTS
+    import filetype
+
+    return filetype.is_video(path)
+
+
 def get_video_codec(filepath):
+    import ffmpeg
+
     try:
-        probe = ffmpeg.probe(filepath)
+        metadata = probe(filepath)
     except ffmpeg.Error as e:
         logger.error(e.stderr.decode("utf-8"))
         raise e
 
-    video_stream = next((stream for stream in probe["streams"] if stream["codec_type"] == "video"), None)
+    video_stream = next((stream for stream in metadata["streams"] if stream["codec_type"] == "video"), None)
     return video_stream["codec_name"] if video_stream else None
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """Convert an ffmpeg bitrate such as "800k" or "2M" to bits per second"""
+    multipliers = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}
+    if bitrate[-1] in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+    return int(float(bitrate))
+
+
+@functools.lru_cache(maxsize=None)
+def can_encode(encoder: str, global_args: Tuple[str, ...] = (), filters: str = "null") -> bool:
+    """
+    Whether ffmpeg can encode with the given encoder here, e.g. h264_nvenc needs an NVIDIA GPU at runtime.
+
+    Args:
+        encoder (str): Name of the ffmpeg encoder
+        global_args (Tuple[str, ...], optional): Options the encoder needs before the inputs, e.g. a device.
+        filters (str, optional): Filters the encoder needs its frames to go through, e.g. a hardware upload.
+    """
+    ffmpeg_cmd = ["ffmpeg", "-v", "error", "-nostdin", *global_args]
+    ffmpeg_cmd.extend(["-f", "lavfi", "-i", "color=size=256x256:duration=0.1", "-vf", filters])
+    ffmpeg_cmd.extend(["-c:v", encoder, "-f", "null", "-"])
+    try:
+        return subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+
+def detect_hwaccel() -> Optional[str]:
+    """Hardware acceleration available for encoding: "cuda" (NVENC), "vaapi" (Intel/AMD) or None"""
+    if can_encode("h264_nvenc"):
+        return "cuda"
+    if os.path.exists(VAAPI_DEVICE) and can_encode("h264_vaapi", ("-vaapi_device", VAAPI_DEVICE), "format=nv12,hwupload"):
+        return "vaapi"
+    return None